@@ -7,7 +7,7 @@ This server provides tools for querying files in a directory using LLMs:
  - 'map_query_tool' runs a query against all files specified
  - 'map_query_tool_regex' is similar to 'map_query_tool' except it runs the query against all files whose filename matches a regex
  - 'map_query_tool_regex_sampled' is similar to 'map_query_tool_regex' except it takes a random sample (without replacement) of at most sample_size
- - 'get_overview' extracts a brief overview of at most 100 files in the directory. If number of files >100, then a random sample of files is chosen.
+ - 'get_overview' extracts a brief overview of at most 100 files in the directory. If number of files >100, then a fixed pseudo-random sample of files (by filename hash) is chosen. Generated as a Gemini batch job unless fast=True.
 
 Systematic Methodology:
 
@@ -36,20 +36,45 @@ Remember: Be thorough, avoid assumptions, and use multiple queries if needed to
 """
 
 import asyncio
+import hashlib
+import heapq
 import json
 import logging
 import mimetypes
+import os
 import random
 import re
+import sqlite3
+import threading
+import time
+from contextlib import asynccontextmanager
+from functools import lru_cache
 from pathlib import Path
-from typing import Any, Iterator
+from typing import Any, AsyncIterator, Awaitable, Callable, Iterator
+from uuid import uuid4
 
+import httpx
+import orjson
 from google import genai
+from google.genai import errors as genai_errors
 from google.genai import types
-from mcp.server.fastmcp import FastMCP
+from mcp.server.fastmcp import Context, FastMCP
 from mcp.types import TextContent, EmbeddedResource, Resource
 from pydantic import AnyUrl
-from tenacity import retry, stop_after_attempt
+from tenacity import (
+    RetryCallState,
+    before_sleep_log,
+    retry,
+    retry_if_exception,
+    stop_after_attempt,
+    wait_random_exponential,
+)
+
+try:
+    import numpy as np
+    from fastembed import TextEmbedding
+except ImportError:
+    TextEmbedding = None
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -61,6 +86,54 @@ MODEL_NAME = "gemini-2.5-flash-preview-05-20"
 MAX_FILES_FOR_DIR_TREE = 100
 OVERVIEW_MAX_FILES = 100
 OVERVIEW_FILENAME = "_OVERVIEW.json"
+OVERVIEW_FORMAT_VERSION = 1
+CACHE_FILENAME = "_CACHE.db"
+CACHE_TTL_SECONDS = 24 * 60 * 60
+CACHE_PURGE_INTERVAL_SECONDS = 60 * 60
+GEMINI_REQUESTS_PER_MINUTE = 1000
+GEMINI_TOKENS_PER_MINUTE = 1_000_000
+BYTES_PER_TOKEN = 4
+# Rough Gemini token costs for non-text inputs
+IMAGE_TOKENS = 258
+PDF_TOKENS_PER_PAGE = 258
+PDF_BYTES_PER_PAGE = 100_000
+AUDIO_TOKENS_PER_BYTE = 32 / 16_000  # 32 tokens/s at ~128 kbps
+VIDEO_TOKENS_PER_BYTE = 263 / 125_000  # 263 tokens/s at ~1 Mbps
+OTHER_PART_TOKENS = 258
+RETRY_MAX_ATTEMPTS = 5
+RETRY_MIN_WAIT_SECONDS = 1
+RETRY_MAX_WAIT_SECONDS = 30
+RETRYABLE_STATUS_CODES = {429, 500, 503, 504}
+OVERVIEW_MAX_BYTES_PER_FILE = 64_000
+OVERVIEW_MAX_TOKENS_PER_BINARY_FILE = 32_000
+TEXT_SNIFF_BYTES = 8192
+TRUNCATION_MARKER = b"\n...[TRUNCATED]...\n"
+TRUNCATED_RESPONSE_PREFIX = "[TRUNCATED: only the start and end of this file were analyzed] "
+TINY_FILE_BYTES = 8
+MEDIA_SKIP_BYTES = 10 * 1024 * 1024
+MEDIA_MIME_PREFIXES = ("image/", "audio/", "video/")
+# Whole words only, so "intermediate", "figure out" or "unsound" do not count
+MEDIA_QUERY_PATTERN = re.compile(
+    r"\b(?:image|picture|photo|visual|chart|diagram|figure|"
+    r"audio|sound|speech|music|video|media)s?\b(?! out\b)",
+    re.IGNORECASE,
+)
+BATCH_FILES_PER_CALL = 8
+BATCH_MAX_FILE_BYTES = 32_000
+TEXT_MIME_TYPES = ("application/json", "application/xml", "application/javascript")
+BATCH_JOB_MAX_INLINE_BYTES = 20 * 1024 * 1024
+BATCH_JOB_POLL_MIN_SECONDS = 5
+BATCH_JOB_POLL_MAX_SECONDS = 60
+BATCH_JOB_TIMEOUT_SECONDS = 30 * 60
+OVERVIEW_QUERY = "give overview. Use dense langauge so that fewest words carry most meaning."
+FILE_MEMORY_COPIES = 3
+FALLBACK_MEMORY_BUDGET_BYTES = 1024 * 1024 * 1024
+SEMANTIC_CACHE_MODEL = "BAAI/bge-small-en-v1.5"
+SEMANTIC_CACHE_THRESHOLD = 0.9
+SEMANTIC_CACHE_EMBEDDINGS = 64
+
+# Called with (files done, total files, names of the files just finished)
+ProgressCallback = Callable[[float, float | None, str | None], Awaitable[None]]
 
 # Initialize FastMCP server
 mcp = FastMCP("file-query-server")
@@ -97,6 +170,347 @@ Focus your analysis on: {focus}
 Start by getting an overview of the directory structure and contents.
 """
 
+SINGLE_FILE_PROMPT = "answer the following query about the preceding file. Use dense language to convey the most using fewest words. Your answer must be grounded in the document."
+
+BATCH_PROMPT = """answer the following query separately for each of the preceding numbered files. Use dense language to convey the most using fewest words. Each answer must be grounded in its own file.
+Reply with a JSON object mapping each file number to its answer, e.g. {"1": "...", "2": "..."}."""
+
+
+BATCH_JOB_DONE_STATES = {
+    types.JobState.JOB_STATE_SUCCEEDED,
+    types.JobState.JOB_STATE_FAILED,
+    types.JobState.JOB_STATE_CANCELLED,
+    types.JobState.JOB_STATE_EXPIRED,
+}
+
+
+def dumps_json(obj: Any) -> str:
+    """Serialize a tool response as indented JSON."""
+    return orjson.dumps(obj, option=orjson.OPT_INDENT_2).decode()
+
+
+def is_text_mime(mime_type: str) -> bool:
+    """Whether a MIME type is plain text the model reads as such."""
+    return mime_type.startswith("text/") or mime_type in TEXT_MIME_TYPES
+
+
+async def cancel_tasks(tasks: list[asyncio.Task]) -> None:
+    """Cancel any unfinished tasks and wait for them to wind down."""
+    for task in tasks:
+        if not task.done():
+            task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def base64_size(size: int) -> int:
+    """Return the length of size bytes once base64-encoded in a request body."""
+    return -(-size // 3) * 4
+
+
+def estimate_tokens(mime_type: str, size: int) -> float:
+    """Roughly estimate the input tokens Gemini counts for a file part."""
+    if is_text_mime(mime_type):
+        return size / BYTES_PER_TOKEN
+    if mime_type.startswith("image/"):
+        return IMAGE_TOKENS
+    if mime_type == "application/pdf":
+        return -(-size // PDF_BYTES_PER_PAGE) * PDF_TOKENS_PER_PAGE
+    if mime_type.startswith("audio/"):
+        return size * AUDIO_TOKENS_PER_BYTE
+    if mime_type.startswith("video/"):
+        return size * VIDEO_TOKENS_PER_BYTE
+    # No known per-type cost, so assume the bytes are read like text to keep large
+    # archives and blobs from looking cheap
+    return max(OTHER_PART_TOKENS, size / BYTES_PER_TOKEN)
+
+
+@lru_cache(maxsize=256)
+def compile_pattern(pattern: str) -> re.Pattern:
+    """Compile a filename regex, reusing patterns seen in earlier tool calls."""
+    return re.compile(pattern)
+
+
+def available_memory() -> int | None:
+    """Return the available physical memory in bytes, or None if unknown.
+
+    Prefers MemAvailable from /proc/meminfo, which unlike free pages counts
+    reclaimable page cache, and falls back to sysconf elsewhere.
+    """
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+class MemoryBudget:
+    """Limits the total bytes of file contents held in memory by concurrent tasks."""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.used = 0
+        self.condition = asyncio.Condition()
+
+    @asynccontextmanager
+    async def reserve(self, size: int):
+        """Wait until size bytes fit in the budget and hold them for the block."""
+        size = min(size, self.limit)
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.used + size <= self.limit)
+            self.used += size
+        try:
+            yield
+        finally:
+            async with self.condition:
+                self.used -= size
+                self.condition.notify_all()
+
+
+def is_transient_error(e: BaseException) -> bool:
+    """Whether a failed Gemini call is worth retrying."""
+    if isinstance(e, genai_errors.APIError):
+        if e.code not in RETRYABLE_STATUS_CODES:
+            return False
+        # A longer requested delay (e.g. an exhausted daily quota) would stall the
+        # tool call, and retrying any sooner would only fail again
+        requested = retry_after_seconds(e)
+        return requested is None or requested <= RETRY_MAX_WAIT_SECONDS
+    return isinstance(e, httpx.TransportError)
+
+
+def retry_after_seconds(e: BaseException) -> float | None:
+    """Return the delay the service asked for before retrying, if any."""
+    if not isinstance(e, genai_errors.APIError):
+        return None
+    headers = getattr(e.response, "headers", None)
+    if headers and headers.get("retry-after"):
+        try:
+            return float(headers["retry-after"])
+        except ValueError:
+            pass
+    if isinstance(e.details, dict):
+        for detail in e.details.get("error", {}).get("details", []):
+            delay = detail.get("retryDelay") if isinstance(detail, dict) else None
+            if isinstance(delay, str) and delay.endswith("s"):
+                try:
+                    return float(delay[:-1])
+                except ValueError:
+                    pass
+    return None
+
+
+_backoff = wait_random_exponential(min=RETRY_MIN_WAIT_SECONDS, max=RETRY_MAX_WAIT_SECONDS)
+
+
+def wait_for_retry(retry_state: RetryCallState) -> float:
+    """Wait with jittered exponential backoff, or longer if the service asks for it.
+
+    Never waits more than RETRY_MAX_WAIT_SECONDS.
+    """
+    delay = _backoff(retry_state)
+    requested = retry_after_seconds(retry_state.outcome.exception())
+    if requested is not None:
+        delay = max(delay, requested)
+    return min(delay, RETRY_MAX_WAIT_SECONDS)
+
+
+class RateLimiter:
+    """Token bucket that keeps usage under a per-minute limit.
+
+    The rate halves whenever the service reports a rate limit and climbs back
+    towards the configured limit with each successful request.
+    """
+
+    def __init__(self, per_minute: float):
+        self.max_rate = per_minute / 60
+        self.rate = self.max_rate
+        self.capacity = per_minute
+        self.tokens = per_minute
+        self.updated = time.monotonic()
+
+    async def acquire(self, amount: float = 1) -> None:
+        """Wait until amount can be spent without exceeding the rate."""
+        amount = min(amount, self.capacity)
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= amount:
+                self.tokens -= amount
+                return
+            await asyncio.sleep((amount - self.tokens) / self.rate)
+
+    def throttle(self) -> None:
+        """Halve the rate and drain the bucket after a rate limit error."""
+        self.rate = max(self.rate / 2, self.max_rate / 100)
+        self.tokens = 0
+
+    def recover(self) -> None:
+        """Step the rate back up towards the configured limit."""
+        self.rate = min(self.rate + self.max_rate / 100, self.max_rate)
+
+
+class SQLiteCache:
+    """Base for caches persisted in SQLite and called from worker threads.
+
+    Database errors are logged and treated as cache misses, so a broken cache
+    never costs an answer. Rows older than the TTL are deleted periodically.
+    """
+
+    table = ""
+
+    def __init__(self, db_path: Path, ttl_seconds: int = CACHE_TTL_SECONDS):
+        self.ttl_seconds = ttl_seconds
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.last_purge = 0.0
+
+    def _execute(self, sql: str, params: tuple = ()) -> list[tuple] | None:
+        """Run a statement and commit, returning its rows or None on a database error."""
+        with self.lock:
+            try:
+                rows = self.conn.execute(sql, params).fetchall()
+                self.conn.commit()
+                return rows
+            except sqlite3.Error as e:
+                logger.warning(f"Cache error in {self.table}: {e}")
+                return None
+
+    def purge_expired(self) -> None:
+        """Delete rows older than the TTL."""
+        self.last_purge = time.time()
+        self._execute(
+            f"DELETE FROM {self.table} WHERE ts < ?",
+            (int(self.last_purge) - self.ttl_seconds,),
+        )
+
+    def _maybe_purge(self) -> None:
+        if time.time() - self.last_purge > CACHE_PURGE_INTERVAL_SECONDS:
+            self.purge_expired()
+
+
+class ResponseCache(SQLiteCache):
+    """Exact-match cache of LLM responses, persisted in SQLite."""
+
+    table = "responses"
+
+    def __init__(self, db_path: Path, ttl_seconds: int = CACHE_TTL_SECONDS):
+        super().__init__(db_path, ttl_seconds)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses "
+            "(key BLOB PRIMARY KEY, response TEXT, ts INTEGER)"
+        )
+        self.conn.commit()
+        self.purge_expired()
+
+    @staticmethod
+    def make_key(bytes_content: bytes, query: str, max_tokens: int) -> bytes:
+        """Build the cache key from file contents, query, model and token limit."""
+        h = hashlib.sha256(bytes_content)
+        for field in (query, MODEL_NAME, str(max_tokens)):
+            h.update(b"\0")
+            h.update(field.encode())
+        return h.digest()
+
+    def get(self, key: bytes) -> str | None:
+        """Return the cached response for key, or None if missing or expired."""
+        rows = self._execute(
+            "SELECT response FROM responses WHERE key = ? AND ts >= ?",
+            (key, int(time.time()) - self.ttl_seconds),
+        )
+        return rows[0][0] if rows else None
+
+    def put(self, key: bytes, response: str) -> None:
+        """Store a response under key."""
+        self._execute(
+            "INSERT OR REPLACE INTO responses (key, response, ts) VALUES (?, ?, ?)",
+            (key, response, int(time.time())),
+        )
+        self._maybe_purge()
+
+
+class SemanticCache(SQLiteCache):
+    """Cache of LLM responses matched by query embedding similarity, persisted in SQLite."""
+
+    table = "semantic_responses"
+
+    def __init__(
+        self,
+        db_path: Path,
+        threshold: float = SEMANTIC_CACHE_THRESHOLD,
+        ttl_seconds: int = CACHE_TTL_SECONDS,
+    ):
+        if TextEmbedding is None:
+            raise ImportError("fastembed is required for the semantic cache")
+        super().__init__(db_path, ttl_seconds)
+        self.threshold = threshold
+        self.model = TextEmbedding(SEMANTIC_CACHE_MODEL)
+        # A query is looked up once per file, so embed each query only once; the
+        # lock keeps concurrent lookups of a new query from all missing the cache
+        self.embed_lock = threading.Lock()
+        self._embed_cached = lru_cache(maxsize=SEMANTIC_CACHE_EMBEDDINGS)(self._embed)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS semantic_responses "
+            "(file_key BLOB, embedding BLOB, response TEXT, ts INTEGER)"
+        )
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS semantic_responses_file_key "
+            "ON semantic_responses (file_key)"
+        )
+        self.conn.commit()
+        self.purge_expired()
+
+    @staticmethod
+    def make_file_key(bytes_content: bytes, max_tokens: int) -> bytes:
+        """Build the per-file bucket key from file contents, model and token limit."""
+        h = hashlib.sha256(bytes_content)
+        for field in (MODEL_NAME, str(max_tokens)):
+            h.update(b"\0")
+            h.update(field.encode())
+        return h.digest()
+
+    def embed(self, query: str) -> "np.ndarray":
+        """Return the normalized embedding of a query, computing it once per query."""
+        with self.embed_lock:
+            return self._embed_cached(query)
+
+    def _embed(self, query: str) -> "np.ndarray":
+        embedding = np.asarray(next(iter(self.model.embed([query]))), dtype=np.float32)
+        embedding /= np.linalg.norm(embedding)
+        # Shared between lookups through the cache
+        embedding.setflags(write=False)
+        return embedding
+
+    def get(self, file_key: bytes, embedding: "np.ndarray") -> str | None:
+        """Return the response of the most similar cached query above the threshold."""
+        rows = self._execute(
+            "SELECT embedding, response FROM semantic_responses "
+            "WHERE file_key = ? AND ts >= ?",
+            (file_key, int(time.time()) - self.ttl_seconds),
+        )
+        best_response, best_similarity = None, self.threshold
+        for blob, response in rows or []:
+            similarity = float(np.dot(np.frombuffer(blob, dtype=np.float32), embedding))
+            if similarity >= best_similarity:
+                best_response, best_similarity = response, similarity
+        return best_response
+
+    def put(self, file_key: bytes, embedding: "np.ndarray", response: str) -> None:
+        """Store a response under file_key with its query embedding."""
+        self._execute(
+            "INSERT INTO semantic_responses (file_key, embedding, response, ts) "
+            "VALUES (?, ?, ?, ?)",
+            (file_key, embedding.tobytes(), response, int(time.time())),
+        )
+        self._maybe_purge()
+
+
 class FileQueryService:
     def __init__(self, root_directory: str):
         self.root_directory = Path(root_directory).resolve()
@@ -104,72 +518,423 @@ class FileQueryService:
             raise ValueError(f"Directory {root_directory} does not exist")
         if not self.root_directory.is_dir():
             raise ValueError(f"{root_directory} is not a directory")
+
+        self._mime_cache: dict[str, str] = {}
+        self.request_limiter = RateLimiter(GEMINI_REQUESTS_PER_MINUTE)
+        self.token_limiter = RateLimiter(GEMINI_TOKENS_PER_MINUTE)
+        # Each file's contents are held several times over (raw bytes, base64, request
+        # body), so large files also wait for room in a budget of half the free memory,
+        # shared by all concurrent requests
+        memory = available_memory()
+        self.memory_budget = MemoryBudget(
+            memory // 2 if memory else FALLBACK_MEMORY_BUDGET_BYTES
+        )
+
+        # Shared across all requests so connections are pooled and reused
+        self.client = genai.Client()
+
+        try:
+            self.cache = ResponseCache(self.root_directory / CACHE_FILENAME)
+        except sqlite3.Error as e:
+            logger.warning(f"Response cache disabled: {e}")
+            self.cache = None
+
+        self.semantic_cache = None
+        if os.getenv("MQ_SEMANTIC_CACHE") == "1":
+            # Loading the embedding model may download it, which can fail in many ways;
+            # none of them should stop the server
+            try:
+                self.semantic_cache = SemanticCache(self.root_directory / CACHE_FILENAME)
+            except Exception as e:
+                logger.warning(f"Semantic cache disabled: {e}")
         
         logger.info(f"Initialized FileQueryService for directory: {self.root_directory}")
 
-    def file_to_part(self, file_path: Path) -> types.Part | None:
-        """Convert file to Gemini Part object."""
-        try:
-            with open(file_path, "rb") as f:
-                bytes_content = f.read()
-            mime_type, _ = mimetypes.guess_type(str(file_path))
+    def guess_mime_type(self, file_path: Path) -> str:
+        """Guess the MIME type of a file from its suffix."""
+        suffix = file_path.suffix
+        mime_type = self._mime_cache.get(suffix)
+        if mime_type is None:
+            mime_type, _ = mimetypes.guess_type(f"file{suffix}")
             if mime_type is None:
                 mime_type = "application/octet-stream"
-            return types.Part.from_bytes(data=bytes_content, mime_type=mime_type)
+            self._mime_cache[suffix] = mime_type
+        return mime_type
+
+    async def _read_bytes(self, file_path: Path) -> bytes:
+        """Read a file without blocking the event loop."""
+        return await asyncio.to_thread(file_path.read_bytes)
+
+    @staticmethod
+    def _looks_like_text(file_path: Path) -> bool:
+        """Sniff the start of a file with an unhelpful MIME type for UTF-8 text."""
+        try:
+            with open(file_path, "rb") as f:
+                sample = f.read(TEXT_SNIFF_BYTES)
+        except OSError:
+            return False
+        if b"\0" in sample:
+            return False
+        try:
+            sample.decode("utf-8")
+        except UnicodeDecodeError as e:
+            # Tolerate a multi-byte character cut off at the end of the sample
+            return e.start >= len(sample) - 3
+        return True
+
+    @staticmethod
+    def _read_head_and_tail(file_path: Path, half: int) -> bytes:
+        """Read the first and last half bytes of a text file, joined by a marker."""
+        with open(file_path, "rb") as f:
+            head = f.read(half)
+            f.seek(-half, os.SEEK_END)
+            tail = f.read()
+        # Drop any multi-byte character split at the cut points
+        head = head.decode("utf-8", errors="ignore").encode()
+        tail = tail.decode("utf-8", errors="ignore").encode()
+        return head + TRUNCATION_MARKER + tail
+
+    def is_text_file(self, file_path: Path) -> bool:
+        """Whether a file is text, by MIME type or by sniffing when the type is unknown."""
+        mime_type = self.guess_mime_type(file_path)
+        if is_text_mime(mime_type):
+            return True
+        return mime_type == "application/octet-stream" and self._looks_like_text(file_path)
+
+    async def _read_for_query(
+        self, file_path: Path, max_file_bytes: int | None = None
+    ) -> tuple[bytes, bool]:
+        """Read a file, keeping only its head and tail if it is text larger than max_file_bytes.
+
+        Returns the contents and whether they were truncated.
+        """
+        if (
+            max_file_bytes is not None
+            and file_path.stat().st_size > max_file_bytes
+            and self.is_text_file(file_path)
+        ):
+            content = await asyncio.to_thread(
+                self._read_head_and_tail, file_path, max_file_bytes // 2
+            )
+            return content, True
+        return await self._read_bytes(file_path), False
+
+    def file_to_part(self, file_path: Path, bytes_content: bytes) -> types.Part | None:
+        """Convert file contents to Gemini Part object."""
+        try:
+            return types.Part.from_bytes(
+                data=bytes_content, mime_type=self.guess_mime_type(file_path)
+            )
         except Exception:
             return None
 
-    @retry(stop=stop_after_attempt(3))
+    def is_batchable(self, file_path: Path) -> bool:
+        """Whether a file is small text that can share a Gemini call with others."""
+        mime_type = self.guess_mime_type(file_path)
+        if not is_text_mime(mime_type):
+            return False
+        try:
+            return file_path.stat().st_size <= BATCH_MAX_FILE_BYTES
+        except OSError:
+            return False
+
+    def trivial_response(
+        self, file_path: Path, query: str, max_binary_tokens: int | None = None
+    ) -> str | None:
+        """Answer without the LLM for files it cannot say anything useful about.
+
+        Covers empty files, files small enough to quote in full, large media files
+        when the query does not ask about media, and binary files estimated at more
+        than max_binary_tokens input tokens.
+        """
+        try:
+            size = file_path.stat().st_size
+        except OSError:
+            return None
+        if size == 0:
+            return "<empty file>"
+        if size < TINY_FILE_BYTES:
+            try:
+                content = file_path.read_bytes().decode("utf-8", errors="replace")
+            except OSError:
+                return None
+            return f"<{size}-byte file containing {content!r}>"
+        mime_type = self.guess_mime_type(file_path)
+        if (
+            mime_type.startswith(MEDIA_MIME_PREFIXES)
+            and size > MEDIA_SKIP_BYTES
+            and not MEDIA_QUERY_PATTERN.search(query)
+        ):
+            return f"<{mime_type} file, {size} bytes - not analyzed>"
+        if (
+            max_binary_tokens is not None
+            and estimate_tokens(mime_type, size) > max_binary_tokens
+            and not self.is_text_file(file_path)
+        ):
+            return f"<{mime_type} file, {size} bytes - too large, not analyzed>"
+        return None
+
+    async def _cache_get(
+        self, bytes_content: bytes, query: str, max_tokens: int
+    ) -> tuple[str | None, tuple]:
+        """Look up a response in the response caches.
+
+        Returns the cached response (or None) and the keys to store a fresh one under.
+        """
+        cache_key = None
+        if self.cache is not None:
+            cache_key = ResponseCache.make_key(bytes_content, query, max_tokens)
+            cached = await asyncio.to_thread(self.cache.get, cache_key)
+            if cached is not None:
+                return cached, ()
+
+        semantic_key = query_embedding = None
+        if self.semantic_cache is not None:
+            semantic_key = SemanticCache.make_file_key(bytes_content, max_tokens)
+            query_embedding = await asyncio.to_thread(self.semantic_cache.embed, query)
+            cached = await asyncio.to_thread(
+                self.semantic_cache.get, semantic_key, query_embedding
+            )
+            if cached is not None:
+                return cached, ()
+
+        return None, (cache_key, semantic_key, query_embedding)
+
+    async def _cache_put(self, keys: tuple, result: str | None) -> None:
+        """Store a fresh response under the keys returned by _cache_get."""
+        if result is None or not keys:
+            return
+        cache_key, semantic_key, query_embedding = keys
+        if cache_key is not None:
+            await asyncio.to_thread(self.cache.put, cache_key, result)
+        if semantic_key is not None:
+            await asyncio.to_thread(
+                self.semantic_cache.put, semantic_key, query_embedding, result
+            )
+
+    @retry(
+        retry=retry_if_exception(is_transient_error),
+        wait=wait_for_retry,
+        stop=stop_after_attempt(RETRY_MAX_ATTEMPTS),
+        before_sleep=before_sleep_log(logger, logging.WARNING),
+        reraise=True,
+    )
+    async def _generate_content(
+        self, contents: list, config: types.GenerateContentConfig, input_tokens: float
+    ) -> types.GenerateContentResponse:
+        """Call Gemini once the request and token rate limits allow it.
+
+        Transient errors are retried with jittered exponential backoff.
+        """
+        await self.request_limiter.acquire()
+        await self.token_limiter.acquire(input_tokens)
+        try:
+            response = await self.client.aio.models.generate_content(
+                model=MODEL_NAME, contents=contents, config=config
+            )
+        except genai_errors.APIError as e:
+            if e.code == 429:
+                logger.warning("Gemini rate limit hit, slowing down requests")
+                self.request_limiter.throttle()
+                self.token_limiter.throttle()
+            raise
+        self.request_limiter.recover()
+        self.token_limiter.recover()
+        return response
+
     async def _process_single_file(
-        self, file_path: Path, query: str, max_tokens: int = 4096
+        self,
+        file_path: Path,
+        query: str,
+        max_tokens: int = 4096,
+        max_file_bytes: int | None = None,
+        max_binary_tokens: int | None = None,
     ) -> str:
-        """Process a single file against the query using Gemini."""
+        """Process a single file against the query using Gemini.
+
+        Text files larger than max_file_bytes are cut down to their head and tail,
+        and the answer is marked as truncated; binary files estimated at more than
+        max_binary_tokens input tokens are skipped.
+        """
         try:
             logger.debug(f"Processing file: {file_path}")
-            part = self.file_to_part(file_path)
+            trivial = self.trivial_response(file_path, query, max_binary_tokens)
+            if trivial is not None:
+                return trivial
+
+            try:
+                bytes_content, truncated = await self._read_for_query(file_path, max_file_bytes)
+            except OSError:
+                logger.warning(f"Could not read file: {file_path}")
+                return f"Error: Could not read file {file_path}"
+            marker = TRUNCATED_RESPONSE_PREFIX if truncated else ""
+
+            cached, cache_keys = await self._cache_get(bytes_content, query, max_tokens)
+            if cached is not None:
+                logger.debug(f"Cache hit for file: {file_path}")
+                return marker + cached
+
+            part = self.file_to_part(file_path, bytes_content)
             if part is None:
                 logger.warning(f"Could not read file: {file_path}")
                 return f"Error: Could not read file {file_path}"
 
             messages = [
                 part,
-                "answer the following query about the preceding file. Use dense language to convey the most using fewest words. Your answer must be grounded in the document.",
+                SINGLE_FILE_PROMPT,
                 query,
             ]
 
-            client = genai.Client()
-            response = await client.aio.models.generate_content(
-                model=MODEL_NAME,
-                contents=messages,
-                config=types.GenerateContentConfig(
+            response = await self._generate_content(
+                messages,
+                types.GenerateContentConfig(
                     max_output_tokens=max_tokens,
                     thinking_config=types.ThinkingConfig(thinking_budget=0),
                 ),
+                input_tokens=estimate_tokens(
+                    self.guess_mime_type(file_path), len(bytes_content)
+                ),
             )
             result = response.candidates[0].content.parts[0].text
+            await self._cache_put(cache_keys, result)
             logger.debug(f"Successfully processed file: {file_path}")
-            return result
+            return marker + result if result is not None else result
         except Exception as e:
             logger.error(f"Error processing file {file_path}: {e}")
             return f"Error processing file {file_path}: {e}"
 
-    def directory_tree_full(self) -> Iterator[str]:
-        """Recursively list all files in the root directory."""
-        if not self.root_directory.is_dir():
-            return
+    async def _process_file_batch(
+        self, file_paths: list[Path], query: str, max_tokens: int = 4096
+    ) -> dict[Path, str]:
+        """Process several small text files against the query in one Gemini call.
+
+        Files whose answer is missing from the reply fall back to single-file processing.
+        """
+        results = {}
+        pending = []
+        for file_path in file_paths:
+            trivial = self.trivial_response(file_path, query)
+            if trivial is not None:
+                results[file_path] = trivial
+                continue
+            try:
+                bytes_content = await self._read_bytes(file_path)
+            except OSError:
+                logger.warning(f"Could not read file: {file_path}")
+                results[file_path] = f"Error: Could not read file {file_path}"
+                continue
+            cached, cache_keys = await self._cache_get(bytes_content, query, max_tokens)
+            if cached is not None:
+                logger.debug(f"Cache hit for file: {file_path}")
+                results[file_path] = cached
+            else:
+                pending.append((file_path, bytes_content, cache_keys))
 
-        for item in self.root_directory.rglob("*"):
-            if item.is_file():
-                relative_path = str(item.relative_to(self.root_directory))
-                if relative_path != OVERVIEW_FILENAME:
-                    yield relative_path
+        if len(pending) > 1:
+            messages = []
+            for i, (file_path, bytes_content, _) in enumerate(pending, start=1):
+                messages.append(f"FILE {i}:")
+                messages.append(self.file_to_part(file_path, bytes_content))
+            messages += [BATCH_PROMPT, query]
 
-    async def map_query_files(self, query: str, filenames: list[str]) -> dict[str, str]:
-        """Process multiple files concurrently with a query."""
-        logger.info(f"Processing {len(filenames)} files with query: {query[:50]}...")
-        
-        if not isinstance(filenames, list):
-            return {"error": "Filenames must be a list of strings"}
+            try:
+                response = await self._generate_content(
+                    messages,
+                    types.GenerateContentConfig(
+                        max_output_tokens=max_tokens * len(pending),
+                        response_mime_type="application/json",
+                        thinking_config=types.ThinkingConfig(thinking_budget=0),
+                    ),
+                    input_tokens=sum(
+                        estimate_tokens(self.guess_mime_type(fp), len(content))
+                        for fp, content, _ in pending
+                    ),
+                )
+                answers = json.loads(response.text)
+                if not isinstance(answers, dict):
+                    raise ValueError("batch response is not a JSON object")
+            except Exception as e:
+                logger.warning(f"Batch of {len(pending)} files failed, processing singly: {e}")
+                answers = {}
+
+            unanswered = []
+            for i, (file_path, bytes_content, cache_keys) in enumerate(pending, start=1):
+                answer = answers.get(str(i))
+                if isinstance(answer, str):
+                    await self._cache_put(cache_keys, answer)
+                    results[file_path] = answer
+                else:
+                    unanswered.append((file_path, bytes_content, cache_keys))
+            pending = unanswered
+
+        # One at a time, since the whole batch holds a single concurrency slot
+        for file_path, _, _ in pending:
+            results[file_path] = await self._process_single_file(file_path, query, max_tokens)
+        return results
+
+    async def _run_batch_job(
+        self,
+        requests: list[types.InlinedRequest],
+        progress: ProgressCallback | None = None,
+    ) -> list[str | None]:
+        """Submit inline requests as a Gemini batch job and wait for its responses.
+
+        If given, progress is called after every poll with the seconds waited so far
+        and the timeout. The job is cancelled if waiting times out or is interrupted.
+        """
+        job = await self.client.aio.batches.create(model=MODEL_NAME, src=requests)
+        logger.info(f"Submitted batch job {job.name} with {len(requests)} requests")
+
+        try:
+            delay = BATCH_JOB_POLL_MIN_SECONDS
+            started = time.monotonic()
+            while job.state not in BATCH_JOB_DONE_STATES:
+                if time.monotonic() - started > BATCH_JOB_TIMEOUT_SECONDS:
+                    raise TimeoutError(f"Batch job {job.name} did not finish in time")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, BATCH_JOB_POLL_MAX_SECONDS)
+                job = await self.client.aio.batches.get(name=job.name)
+                if progress is not None:
+                    await progress(
+                        min(time.monotonic() - started, BATCH_JOB_TIMEOUT_SECONDS),
+                        BATCH_JOB_TIMEOUT_SECONDS,
+                        f"Batch job {job.state.name if job.state else 'pending'}",
+                    )
+        except BaseException:
+            try:
+                await self.client.aio.batches.cancel(name=job.name)
+            except Exception as e:
+                logger.warning(f"Could not cancel batch job {job.name}: {e}")
+            raise
+
+        if job.state != types.JobState.JOB_STATE_SUCCEEDED:
+            raise RuntimeError(f"Batch job {job.name} ended in state {job.state}")
+
+        answers = []
+        for inlined in job.dest.inlined_responses:
+            try:
+                answers.append(inlined.response.candidates[0].content.parts[0].text)
+            except (AttributeError, IndexError, TypeError):
+                answers.append(None)
+        return answers
+
+    async def map_query_files_batch_job(
+        self,
+        query: str,
+        filenames: list[str],
+        max_tokens: int = 4096,
+        max_file_bytes: int | None = None,
+        max_binary_tokens: int | None = None,
+        progress: ProgressCallback | None = None,
+    ) -> dict[str, str]:
+        """Process multiple files with a query as a discounted Gemini batch job.
+
+        Batch jobs may take minutes to complete; progress, if given, receives a
+        heartbeat while waiting. Files the job does not answer are processed with
+        map_query_files instead. max_file_bytes and max_binary_tokens are applied as
+        in _process_single_file.
+        """
+        logger.info(f"Submitting {len(filenames)} files as batch job with query: {query[:50]}...")
 
         target_files = []
         for filename in filenames:
@@ -181,27 +946,302 @@ class FileQueryService:
             logger.warning("No valid target files found")
             return {"error": "No valid target files found"}
 
-        logger.info(f"Found {len(target_files)} valid files to process")
+        results = {}
+        pending = []
+        unanswered = []
+        truncated_paths = set()
+        # Contents are held until the job is submitted, so only files that fit in
+        # one inline request are read here, within the memory budget; the rest are
+        # processed in real time
+        inline_bytes = 0
+        async with self.memory_budget.reserve(BATCH_JOB_MAX_INLINE_BYTES * FILE_MEMORY_COPIES):
+            for file_path in target_files:
+                relative_path = str(file_path.relative_to(self.root_directory))
+                trivial = self.trivial_response(file_path, query, max_binary_tokens)
+                if trivial is not None:
+                    results[relative_path] = trivial
+                    continue
+                try:
+                    size = file_path.stat().st_size
+                except OSError:
+                    results[relative_path] = f"Error: Could not read file {file_path}"
+                    continue
+                # Text over max_file_bytes is truncated when read, so it needs less room
+                if (
+                    max_file_bytes is not None
+                    and size > max_file_bytes
+                    and self.is_text_file(file_path)
+                ):
+                    size = max_file_bytes + len(TRUNCATION_MARKER)
+                if inline_bytes + base64_size(size) > BATCH_JOB_MAX_INLINE_BYTES:
+                    unanswered.append(relative_path)
+                    continue
+                try:
+                    bytes_content, truncated = await self._read_for_query(
+                        file_path, max_file_bytes
+                    )
+                except OSError:
+                    results[relative_path] = f"Error: Could not read file {file_path}"
+                    continue
+                if truncated:
+                    truncated_paths.add(relative_path)
+                cached, cache_keys = await self._cache_get(bytes_content, query, max_tokens)
+                if cached is not None:
+                    results[relative_path] = cached
+                else:
+                    pending.append((relative_path, file_path, bytes_content, cache_keys))
+                    inline_bytes += base64_size(len(bytes_content))
+
+            if pending:
+                config = types.GenerateContentConfig(
+                    max_output_tokens=max_tokens,
+                    thinking_config=types.ThinkingConfig(thinking_budget=0),
+                )
+                requests = [
+                    types.InlinedRequest(
+                        contents=[
+                            types.Content(
+                                role="user",
+                                parts=[
+                                    self.file_to_part(file_path, bytes_content),
+                                    types.Part.from_text(text=SINGLE_FILE_PROMPT),
+                                    types.Part.from_text(text=query),
+                                ],
+                            )
+                        ],
+                        config=config,
+                    )
+                    for _, file_path, bytes_content, _ in pending
+                ]
+                try:
+                    answers = await self._run_batch_job(requests, progress)
+                except Exception as e:
+                    logger.warning(f"Batch job failed, falling back to real-time processing: {e}")
+                    answers = []
+
+                for (relative_path, _, _, cache_keys), answer in zip(pending, answers):
+                    if answer is None:
+                        unanswered.append(relative_path)
+                    else:
+                        await self._cache_put(cache_keys, answer)
+                        results[relative_path] = answer
+                unanswered += [entry[0] for entry in pending[len(answers):]]
+
+        if unanswered:
+            results.update(
+                await self.map_query_files(
+                    query,
+                    unanswered,
+                    max_file_bytes=max_file_bytes,
+                    max_binary_tokens=max_binary_tokens,
+                )
+            )
+            truncated_paths.difference_update(unanswered)
+
+        for relative_path in truncated_paths:
+            results[relative_path] = TRUNCATED_RESPONSE_PREFIX + results[relative_path]
+
+        # Keep the order of the requested files
+        relative_paths = [str(fp.relative_to(self.root_directory)) for fp in target_files]
+        return {relative_path: results[relative_path] for relative_path in relative_paths}
+
+    def is_internal_file(self, relative_path: str) -> bool:
+        """Whether a file is one of the server's own overview or cache files."""
+        return relative_path.startswith((OVERVIEW_FILENAME, CACHE_FILENAME))
+
+    @staticmethod
+    def _scan_directory(directory: str) -> tuple[list[str], list[str]]:
+        """List the subdirectory and file paths directly inside a directory."""
+        subdirs, files = [], []
+        try:
+            with os.scandir(directory) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.path)
+                    elif entry.is_file():
+                        files.append(entry.path)
+        except OSError as e:
+            logger.warning(f"Could not list directory {directory}: {e}")
+        return subdirs, files
+
+    def directory_tree_full(self) -> Iterator[str]:
+        """Recursively list all files in the root directory."""
+        if not self.root_directory.is_dir():
+            return
+
+        prefix_len = len(os.path.join(self.root_directory, ""))
+        pending = [str(self.root_directory)]
+        while pending:
+            subdirs, files = self._scan_directory(pending.pop())
+            for path in files:
+                relative_path = path[prefix_len:]
+                if not self.is_internal_file(relative_path):
+                    yield relative_path
+            pending.extend(reversed(subdirs))
+
+    def iter_matching(self, regex: re.Pattern) -> Iterator[str]:
+        """Recursively list files whose relative path matches a regex."""
+        for relative_path in self.directory_tree_full():
+            if regex.search(relative_path):
+                yield relative_path
+
+    def sample_matching(self, regex: re.Pattern, sample_size: int) -> list[str]:
+        """Uniformly sample at most sample_size matching files in one pass (reservoir sampling)."""
+        sample = []
+        for i, relative_path in enumerate(self.iter_matching(regex)):
+            if i < sample_size:
+                sample.append(relative_path)
+            else:
+                j = random.randint(0, i)
+                if j < sample_size:
+                    sample[j] = relative_path
+        return sample
+
+    async def directory_tree_full_async(self) -> AsyncIterator[str]:
+        """Recursively list all files in the root directory without blocking the event loop."""
+        prefix_len = len(os.path.join(self.root_directory, ""))
+        pending = [str(self.root_directory)]
+        while pending:
+            subdirs, files = await asyncio.to_thread(self._scan_directory, pending.pop())
+            for path in files:
+                relative_path = path[prefix_len:]
+                if not self.is_internal_file(relative_path):
+                    yield relative_path
+            pending.extend(reversed(subdirs))
+
+    async def iter_matching_async(self, regex: re.Pattern) -> AsyncIterator[str]:
+        """Like iter_matching, but without blocking the event loop."""
+        async for relative_path in self.directory_tree_full_async():
+            if regex.search(relative_path):
+                yield relative_path
+
+    async def map_query_files(
+        self,
+        query: str,
+        filenames: list[str],
+        progress: ProgressCallback | None = None,
+        max_file_bytes: int | None = None,
+        max_binary_tokens: int | None = None,
+    ) -> dict[str, str]:
+        """Process multiple files concurrently with a query."""
+        logger.info(f"Processing {len(filenames)} files with query: {query[:50]}...")
+        
+        if not isinstance(filenames, list):
+            return {"error": "Filenames must be a list of strings"}
+
+        async def iter_filenames():
+            for filename in filenames:
+                yield filename
 
-        # Process files concurrently
+        return await self.map_query_stream(
+            query, iter_filenames(), progress, max_file_bytes, max_binary_tokens
+        )
+
+    async def map_query_stream(
+        self,
+        query: str,
+        filenames: AsyncIterator[str],
+        progress: ProgressCallback | None = None,
+        max_file_bytes: int | None = None,
+        max_binary_tokens: int | None = None,
+    ) -> dict[str, str]:
+        """Process files concurrently with a query, starting each as soon as its name arrives.
+
+        If given, progress is called with the number of files done, the total and the
+        names of the files just finished, as each single-file or batched call completes.
+        max_file_bytes and max_binary_tokens are applied as in _process_single_file.
+        """
         semaphore = asyncio.Semaphore(MAX_CONCURRENT_TASKS)
 
         async def process_with_semaphore(file_path):
+            try:
+                size = file_path.stat().st_size
+            except OSError:
+                size = 0
+            if max_file_bytes is not None and is_text_mime(self.guess_mime_type(file_path)):
+                size = min(size, max_file_bytes)
+            async with semaphore, self.memory_budget.reserve(size * FILE_MEMORY_COPIES):
+                return {
+                    file_path: await self._process_single_file(
+                        file_path,
+                        query,
+                        max_file_bytes=max_file_bytes,
+                        max_binary_tokens=max_binary_tokens,
+                    )
+                }
+
+        async def process_batch_with_semaphore(batch):
             async with semaphore:
-                return await self._process_single_file(file_path, query)
+                return await self._process_file_batch(batch, query)
 
-        tasks = [
-            asyncio.create_task(process_with_semaphore(file_path))
-            for file_path in target_files
-        ]
-
-        results = await asyncio.gather(*tasks, return_exceptions=True)
+        # Small text files share a Gemini call; everything else is processed singly.
+        # Tasks are created explicitly (rather than handing coroutines to gather) so
+        # they start while the filenames are still arriving, and so progress can be
+        # tracked per task with asyncio.wait.
+        target_files = []
+        tasks = []
+        task_paths = []
+        batch = []
+        try:
+            async for filename in filenames:
+                file_path = self.root_directory / filename
+                if not file_path.is_file():
+                    continue
+                target_files.append(file_path)
+                if self.is_batchable(file_path):
+                    batch.append(file_path)
+                    if len(batch) == BATCH_FILES_PER_CALL:
+                        tasks.append(asyncio.create_task(process_batch_with_semaphore(batch)))
+                        task_paths.append(batch)
+                        batch = []
+                else:
+                    tasks.append(asyncio.create_task(process_with_semaphore(file_path)))
+                    task_paths.append([file_path])
+            if batch:
+                tasks.append(asyncio.create_task(process_batch_with_semaphore(batch)))
+                task_paths.append(batch)
+
+            if not target_files:
+                logger.warning("No valid target files found")
+                return {"error": "No valid target files found"}
+
+            logger.info(f"Found {len(target_files)} valid files to process")
+
+            if progress is not None:
+                paths_by_task = dict(zip(tasks, task_paths))
+                pending = set(tasks)
+                files_done = 0
+                while pending:
+                    done, pending = await asyncio.wait(
+                        pending, return_when=asyncio.FIRST_COMPLETED
+                    )
+                    finished = [fp for task in done for fp in paths_by_task[task]]
+                    files_done += len(finished)
+                    await progress(
+                        files_done,
+                        len(target_files),
+                        ", ".join(str(fp.relative_to(self.root_directory)) for fp in finished),
+                    )
+
+            task_results = await asyncio.gather(*tasks, return_exceptions=True)
+        finally:
+            # Don't leave started Gemini calls running if discovery or progress
+            # reporting fails, or the tool call is cancelled
+            await cancel_tasks(tasks)
+
+        results = {}
+        for task_result, paths in zip(task_results, task_paths):
+            if isinstance(task_result, Exception):
+                results.update({fp: task_result for fp in paths})
+            else:
+                results.update(task_result)
 
         # Format results
         result_dict = {}
         success_count = 0
-        for i, result in enumerate(results):
-            relative_path = str(target_files[i].relative_to(self.root_directory))
+        for file_path in target_files:
+            result = results[file_path]
+            relative_path = str(file_path.relative_to(self.root_directory))
             if isinstance(result, Exception):
                 result_dict[relative_path] = f"Task failed: {result}"
                 logger.error(f"Failed to process {relative_path}: {result}")
@@ -218,7 +1258,7 @@ service: FileQueryService = None
 
 
 @mcp.tool()
-async def map_query_tool(query: str, filenames: list[str]) -> str:
+async def map_query_tool(query: str, filenames: list[str], ctx: Context) -> str:
     """
     Query multiple files concurrently using an LLM.
 
@@ -229,12 +1269,12 @@ async def map_query_tool(query: str, filenames: list[str]) -> str:
     if service is None:
         return "Error: Server not configured with a directory"
 
-    result = await service.map_query_files(query, filenames)
-    return json.dumps(result, indent=2)
+    result = await service.map_query_files(query, filenames, ctx.report_progress)
+    return dumps_json(result)
 
 
 @mcp.tool()
-async def map_query_tool_regex(query: str, filename_regex: str) -> str:
+async def map_query_tool_regex(query: str, filename_regex: str, ctx: Context) -> str:
     """
     Query files matching a regex pattern using an LLM.
 
@@ -246,19 +1286,20 @@ async def map_query_tool_regex(query: str, filename_regex: str) -> str:
         return "Error: Server not configured with a directory"
 
     try:
-        regex = re.compile(filename_regex)
-        all_files = list(service.directory_tree_full())
-        target_files = [f for f in all_files if regex.search(f)]
-
-        result = await service.map_query_files(query, target_files)
-        return json.dumps(result, indent=2)
+        regex = compile_pattern(filename_regex)
     except re.error as e:
         return f"Error: Invalid regex pattern: {e}"
 
+    # Start querying matches while the directory walk is still running
+    result = await service.map_query_stream(
+        query, service.iter_matching_async(regex), ctx.report_progress
+    )
+    return dumps_json(result)
+
 
 @mcp.tool()
 async def map_query_tool_regex_sampled(
-    query: str, filename_regex: str, sample_size: int
+    query: str, filename_regex: str, sample_size: int, ctx: Context
 ) -> str:
     """
     Query a random sample of files matching a regex pattern using an LLM.
@@ -272,16 +1313,11 @@ async def map_query_tool_regex_sampled(
         return "Error: Server not configured with a directory"
 
     try:
-        regex = re.compile(filename_regex)
-        all_files = list(service.directory_tree_full())
-        target_files = [f for f in all_files if regex.search(f)]
-
-        # Random sample
-        random.shuffle(target_files)
-        sampled_files = target_files[:sample_size]
+        regex = compile_pattern(filename_regex)
+        sampled_files = await asyncio.to_thread(service.sample_matching, regex, sample_size)
 
-        result = await service.map_query_files(query, sampled_files)
-        return json.dumps(result, indent=2)
+        result = await service.map_query_files(query, sampled_files, ctx.report_progress)
+        return dumps_json(result)
     except re.error as e:
         return f"Error: Invalid regex pattern: {e}"
 
@@ -301,7 +1337,7 @@ def directory_tree() -> str:
         itertools.islice(service.directory_tree_full(), MAX_FILES_FOR_DIR_TREE)
     )
     result = {"truncated": len(files) == MAX_FILES_FOR_DIR_TREE, "files": files}
-    return json.dumps(result, indent=2)
+    return dumps_json(result)
 
 
 @mcp.tool()
@@ -329,14 +1365,77 @@ def ls(path: str = "") -> str:
     except PermissionError:
         return f"Error: Permission denied accessing {target_path}"
 
-    return json.dumps(sorted(items), indent=2)
+    return dumps_json(sorted(items))
+
+
+async def build_overview(
+    fast: bool = False, progress: ProgressCallback | None = None
+) -> dict[str, str]:
+    """Generate an overview of a sample of files and save it to the overview file.
+
+    The real-time (fast) path reports files done; the batch path reports seconds
+    waited for the batch job.
+    """
+    # Sample by filename hash so the same directory always yields the same files,
+    # letting regenerated overviews reuse cached per-file responses
+    selected_files = heapq.nsmallest(
+        OVERVIEW_MAX_FILES,
+        service.directory_tree_full(),
+        key=lambda f: hashlib.blake2b(f.encode(), digest_size=8).digest(),
+    )
+
+    if fast:
+        result = await service.map_query_files(
+            OVERVIEW_QUERY,
+            selected_files,
+            progress,
+            max_file_bytes=OVERVIEW_MAX_BYTES_PER_FILE,
+            max_binary_tokens=OVERVIEW_MAX_TOKENS_PER_BINARY_FILE,
+        )
+    else:
+        result = await service.map_query_files_batch_job(
+            OVERVIEW_QUERY,
+            selected_files,
+            max_file_bytes=OVERVIEW_MAX_BYTES_PER_FILE,
+            max_binary_tokens=OVERVIEW_MAX_TOKENS_PER_BINARY_FILE,
+            progress=progress,
+        )
+
+    # Save overview atomically so readers never see a partially written file. The
+    # temporary name keeps the overview prefix so directory listings skip it, and is
+    # created with open() rather than mkstemp so it gets the usual umask permissions
+    try:
+        tmp_path = service.root_directory / f"{OVERVIEW_FILENAME}.{uuid4().hex}.tmp"
+        try:
+            with open(tmp_path, "x") as f:
+                json.dump({"v": OVERVIEW_FORMAT_VERSION, "data": result}, f, indent=4)
+            os.replace(tmp_path, service.root_directory / OVERVIEW_FILENAME)
+        except BaseException:
+            tmp_path.unlink(missing_ok=True)
+            raise
+    except Exception as e:
+        logger.error(f"Error saving overview: {e}")
+
+    return result
+
+
+def load_overview() -> dict[str, str]:
+    """Load the saved overview, rejecting files without the current format version."""
+    with open(service.root_directory / OVERVIEW_FILENAME, "r") as f:
+        overview = json.load(f)
+    if not isinstance(overview, dict) or overview.get("v") != OVERVIEW_FORMAT_VERSION:
+        raise ValueError("Overview file has an unknown format")
+    return overview["data"]
 
 
 @mcp.tool()
-async def get_overview() -> str:
+async def get_overview(ctx: Context, fast: bool = False) -> str:
     """
     Get a brief overview of files in the directory.
     Uses cached results if available, otherwise generates new overview.
+
+    Args:
+        fast: Generate with real-time requests instead of a cheaper but slower batch job
     """
     if service is None:
         return "Error: Server not configured with a directory"
@@ -345,9 +1444,8 @@ async def get_overview() -> str:
 
     # Try to load existing overview
     try:
-        with open(overview_path, "r") as f:
-            overview_data = json.load(f)
-        return json.dumps(overview_data, indent=2)
+        overview_data = load_overview()
+        return dumps_json(overview_data)
     except Exception as e:
         print(f"Could not load existing overview: {e}")
         # Remove corrupted file
@@ -356,21 +1454,8 @@ async def get_overview() -> str:
         except:
             pass
 
-    # Generate new overview
-    all_files = list(service.directory_tree_full())
-    random.shuffle(all_files)
-    selected_files = all_files[:OVERVIEW_MAX_FILES]
-
-    result = await service.map_query_files("give overview. Use dense langauge so that fewest words carry most meaning.", selected_files)
-
-    # Save overview
-    try:
-        with open(overview_path, "w") as f:
-            json.dump(result, f, indent=4)
-    except Exception as e:
-        print(f"Error saving overview: {e}")
-
-    return json.dumps(result, indent=2)
+    result = await build_overview(fast, ctx.report_progress)
+    return dumps_json(result)
 
 
 @mcp.resource("file://{path}")
@@ -411,32 +1496,15 @@ async def overview_resource() -> str:
         return "Error: Server not configured with a directory"
     
     try:
-        overview_path = service.root_directory / OVERVIEW_FILENAME
-        
         # Try to load existing overview
         try:
-            with open(overview_path, "r") as f:
-                overview_data = json.load(f)
-            return json.dumps(overview_data, indent=2)
+            overview_data = load_overview()
+            return dumps_json(overview_data)
         except Exception:
-            # Generate new overview if not available
-            all_files = list(service.directory_tree_full())
-            random.shuffle(all_files)
-            selected_files = all_files[:OVERVIEW_MAX_FILES]
-            
-            result = await service.map_query_files(
-                "give overview. Use dense langauge so that fewest words carry most meaning.",
-                selected_files
-            )
-            
-            # Save overview
-            try:
-                with open(overview_path, "w") as f:
-                    json.dump(result, f, indent=4)
-            except Exception as e:
-                logger.error(f"Error saving overview: {e}")
-            
-            return json.dumps(result, indent=2)
+            # Generate new overview if not available; resource reads take no
+            # arguments, so use the real-time path rather than wait on a batch job
+            result = await build_overview(fast=True)
+            return dumps_json(result)
     except Exception as e:
         logger.error(f"Error generating overview resource: {e}")
         return f"Error: {e}"